@@ -1,55 +1,259 @@
 import os
 import re
 import json
+import time
+import hashlib
 import argparse
-import markdown
-from atlassian import Confluence
-from google import genai
-from google.genai import types
+import functools
+import html
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 # This script uses the Atlassian Python API to interact with Confluence and the Google Gemini API for generative AI capabilities.
 # Make sure to install the required libraries:
-# pip install atlassian-python-api google-cloud-genai markdown argparse
+# pip install atlassian-python-api google-cloud-genai mistune argparse requests
+# The heavier libraries are imported where they are first needed, to keep startup (and --help) fast.
 
 # Configure Confluence connection
 CONFLUENCE_URL = os.environ.get("CONFLUENCE_URL")
 CONFLUENCE_USERNAME = os.environ.get("CONFLUENCE_USERNAME")
 CONFLUENCE_API_TOKEN = os.environ.get("CONFLUENCE_API_TOKEN")
 
-confluence = Confluence(
-    url=CONFLUENCE_URL,
-    username=CONFLUENCE_USERNAME,
-    password=CONFLUENCE_API_TOKEN
-)
+# Maximum number of attachments uploaded concurrently
+MAX_ATTACHMENT_WORKERS = 8
 
-def get_template(template_name):
+# Number of independent Confluence lookups run concurrently at startup
+MAX_STARTUP_WORKERS = 4
+
+# Use the highest token limit model available to ensure full content processing
+GEMINI_MODEL = "gemini-1.5-pro-latest"
+GEMINI_MAX_OUTPUT_TOKENS = 8192
+
+# Bump when the prompt changes so cached generations from the old prompt are not reused
+PROMPT_VERSION = "v3"
+
+# Abort a streamed generation that emits markdown fences beyond a single ```html wrapper,
+# or that grows past what the output token budget allows (at a generous characters-per-token rate)
+MAX_CODE_FENCES = 2
+MAX_GENERATION_CHARS = GEMINI_MAX_OUTPUT_TOKENS * 6
+
+# Markdown is only split into chunks, converted in parallel, when a single prompt or its output would not fit.
+# Storage-format HTML is estimated at about twice the size of its markdown.
+HTML_GROWTH_RATIO = 2
+MIN_CHUNK_TOKENS = 500
+MAX_GEMINI_WORKERS = 4
+
+# Largest prompt sent in a single Gemini call
+PROMPT_TOKEN_LIMIT = 8192
+
+# Keys that may hold the body of a Confluence template, in order of preference
+TEMPLATE_BODY_KEYS = ('body', 'templateBody', 'contentTemplateBody')
+
+# Local cache for data that rarely changes between runs
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "confluence-md")
+TEMPLATE_CACHE_TTL = 60 * 60  # seconds
+GEMINI_CACHE_DIR = os.path.join(CACHE_DIR, "gemini")
+
+# Generated page titles look like "New Generated Document 001"
+DEFAULT_TITLE_BASE = "New Generated Document"
+_TITLE_RE = re.compile(rf"^{re.escape(DEFAULT_TITLE_BASE)}(?: (\d+))?$")
+TITLE_SEARCH_PAGE_SIZE = 100
+
+# Level-2 markdown headings, used to detect truncated output
+_H2_RE = re.compile(r'^##\s+([^\n]+)', re.MULTILINE)
+
+# Zero-width match before each level-2 heading, used to split markdown into sections
+_H2_SPLIT_RE = re.compile(r'^(?=##\s)', re.MULTILINE)
+
+# A fenced code block, up to its closing fence (or the end of the text if it is never closed)
+_FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})[^\n]*\n.*?(?:^ {0,3}\1[ \t]*(?:\n|\Z)|\Z)', re.MULTILINE | re.DOTALL)
+
+# Runs of whitespace, collapsed in template HTML before it is sent to Gemini
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Languages the Confluence code macro accepts, keyed by common markdown fence tags.
+# Confluence Server/DC shows an error instead of the code for a language it doesn't know,
+# so any tag not listed here is rendered without a language.
+CODE_MACRO_LANGUAGES = {
+    **{name: name for name in (
+        'actionscript3', 'applescript', 'bash', 'c#', 'coldfusion', 'cpp', 'css', 'delphi', 'diff', 'erl',
+        'groovy', 'java', 'jfx', 'js', 'perl', 'php', 'powershell', 'py', 'ruby', 'sass', 'scala', 'sql',
+        'text', 'vb', 'xml', 'yml'
+    )},
+    'sh': 'bash', 'shell': 'bash', 'zsh': 'bash', 'console': 'bash', 'shell-session': 'bash',
+    'cs': 'c#', 'csharp': 'c#',
+    'c': 'cpp', 'c++': 'cpp', 'h': 'cpp', 'hpp': 'cpp',
+    'erlang': 'erl',
+    'javafx': 'jfx',
+    'javascript': 'js', 'jsx': 'js', 'node': 'js', 'typescript': 'js', 'ts': 'js', 'json': 'js', 'jsonc': 'js',
+    'pl': 'perl',
+    'ps1': 'powershell', 'pwsh': 'powershell',
+    'python': 'py', 'python3': 'py',
+    'rb': 'ruby',
+    'scss': 'sass',
+    'txt': 'text', 'plain': 'text', 'plaintext': 'text',
+    'patch': 'diff',
+    'vbnet': 'vb',
+    'html': 'xml', 'xhtml': 'xml', 'svg': 'xml',
+    'yaml': 'yml',
+}
+
+def render_code_macro(code, info=None):
+    """
+    Render a fenced code block as a Confluence code macro.
+    Confluence highlights the macro server-side, so no local syntax highlighting is needed.
+    """
+    tag = info.split(None, 1)[0].lower() if info and info.strip() else None
+    language = CODE_MACRO_LANGUAGES.get(tag)
+    
+    macro = '<ac:structured-macro ac:name="code">'
+    if language:
+        macro += f'<ac:parameter ac:name="language">{html.escape(language)}</ac:parameter>'
+    # "]]>" would end the CDATA section early, so split it across two sections
+    code = code.replace("]]>", "]]]]><![CDATA[>")
+    macro += f'<ac:plain-text-body><![CDATA[{code}]]></ac:plain-text-body></ac:structured-macro>\n'
+    
+    return macro
+
+@functools.lru_cache(maxsize=1)
+def _get_markdown():
+    """
+    Build the markdown renderer once, on first use.
+    """
+    import mistune
+    
+    class ConfluenceRenderer(mistune.HTMLRenderer):
+        """
+        HTML renderer that emits Confluence code macros for code blocks.
+        """
+        def block_code(self, code, info=None):
+            return render_code_macro(code, info)
+    
+    return mistune.create_markdown(
+        renderer=ConfluenceRenderer(escape=False),
+        plugins=['table', 'strikethrough'],
+        hard_wrap=False
+    )
+
+def create_session():
+    """
+    Create a pooled HTTP session so all Confluence calls reuse the same keep-alive connections.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    session = requests.Session()
+    session.headers["Connection"] = "keep-alive"
+    
+    # Retry transient failures and keep a small pool of connections to the Confluence host
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+    )
+    session.mount(CONFLUENCE_URL or "https://", adapter)
+    
+    return session
+
+@functools.lru_cache(maxsize=1)
+def _get_confluence():
+    """
+    Create the Confluence client once, on first use, on top of the pooled session.
+    """
+    from atlassian import Confluence
+    
+    return Confluence(
+        url=CONFLUENCE_URL,
+        username=CONFLUENCE_USERNAME,
+        password=CONFLUENCE_API_TOKEN,
+        session=create_session()
+    )
+
+@functools.lru_cache(maxsize=None)
+def _read_markdown(path, mtime_ns, size):
+    """
+    Read a markdown file.
+    Cached on (path, mtime_ns, size) so the file is only read once per run,
+    while edits to the file still invalidate the cache.
+    """
+    with open(path, 'r', encoding='utf-8') as md_file:
+        return md_file.read()
+
+@functools.lru_cache(maxsize=None)
+def _render_markdown(path, mtime_ns, size):
+    """
+    Convert a markdown file to HTML, cached on the same key as _read_markdown.
+    """
+    # Use mistune to convert markdown to HTML
+    return _get_markdown()(_read_markdown(path, mtime_ns, size))
+
+def read_markdown(markdown_file):
+    """
+    Return the content of a markdown file, using the read cache.
+    """
+    stat = os.stat(markdown_file)
+    return _read_markdown(markdown_file, stat.st_mtime_ns, stat.st_size)
+
+def render_markdown(markdown_file):
+    """
+    Return the HTML conversion of a markdown file, rendering it at most once per run.
+    """
+    stat = os.stat(markdown_file)
+    return _render_markdown(markdown_file, stat.st_mtime_ns, stat.st_size)
+
+@functools.lru_cache(maxsize=1)
+def get_templates_by_name(refresh=False):
+    """
+    Fetch all Confluence templates as a {name: template} dict.
+    The template list is cached on disk for TEMPLATE_CACHE_TTL seconds, per Confluence instance and user.
+    """
+    cache_key = hashlib.sha1(f"{CONFLUENCE_URL}|{CONFLUENCE_USERNAME}".encode()).hexdigest()[:12]
+    cache_file = os.path.join(CACHE_DIR, f"templates.{cache_key}.json")
+    
+    templates = None
+    if not refresh and os.path.exists(cache_file) and \
+       time.time() - os.path.getmtime(cache_file) < TEMPLATE_CACHE_TTL:
+        try:
+            with open(cache_file, 'r') as f:
+                templates = json.load(f)
+            print(f"Using cached templates from {cache_file}")
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read template cache: {e}")
+    
+    if templates is None:
+        templates = _get_confluence().get_content_templates()
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(cache_file, 'w') as f:
+                json.dump(templates, f)
+        except (OSError, TypeError) as e:
+            print(f"Warning: Could not write template cache: {e}")
+    
+    return {template['name']: template for template in templates}
+
+def get_template(template_name, refresh=False):
     """
     Fetch a Confluence template by name.
     """
-    templates = confluence.get_content_templates()
-    print(f"Available templates: {[template['name'] for template in templates]}")
+    templates = get_templates_by_name(refresh)
+    print(f"Available templates: {list(templates)}")
     
     # Debug the structure of templates
     if templates:
-        print(f"Template structure example: {list(templates[0].keys())}")
+        print(f"Template structure example: {list(next(iter(templates.values())).keys())}")
     
     # Find the template by name
-    for template in templates:
-        if template['name'] == template_name:
-            print(f"Found template: {template_name}")
-            # Print the template structure to debug
-            print(f"Template keys: {list(template.keys())}")
+    template = templates.get(template_name)
+    if template:
+        print(f"Found template: {template_name}")
+        # Print the template structure to debug
+        print(f"Template keys: {list(template.keys())}")
+        
+        # Try to extract the template content directly if possible
+        body_key = next((key for key in TEMPLATE_BODY_KEYS if key in template), None)
+        return {body_key: template[body_key]} if body_key else template
             
-            # Try to extract the template content directly if possible
-            if 'body' in template:
-                return {'body': template['body']}
-            elif 'templateBody' in template:
-                return {'templateBody': template['templateBody']}
-            elif 'contentTemplateBody' in template:
-                return {'contentTemplateBody': template['contentTemplateBody']}
-            else:
-                return template
-                
     print(f"Template '{template_name}' not found.")
     return None
 
@@ -60,7 +264,7 @@ def get_parent_page_id(space, parent_page_name):
     if not parent_page_name:
         return None
         
-    parent = confluence.get_page_by_title(space, parent_page_name)
+    parent = _get_confluence().get_page_by_title(space, parent_page_name)
     if parent:
         print(f"Found parent page: {parent_page_name} with ID: {parent['id']}")
         return parent['id']
@@ -68,74 +272,280 @@ def get_parent_page_id(space, parent_page_name):
         print(f"Parent page '{parent_page_name}' not found in space '{space}'.")
         return None
 
-def create_or_edit_page(space, title, content, parent_id=None):
+def create_or_edit_page(space, title, content, parent_id=None, existing_page=None):
     """
     Create or edit a Confluence page.
+    
+    Args:
+        existing_page (dict): Result of a previous get_page_by_title lookup, or None if the page does not exist
+    
+    Returns:
+        str: ID of the created or updated page
     """
-    existing_page = confluence.get_page_by_title(space, title)
     if existing_page:
         # Update the existing page
-        confluence.update_page(
+        _get_confluence().update_page(
             page_id=existing_page['id'],
             title=title,
             body=content
         )
         print(f"Page '{title}' updated successfully.")
+        return existing_page['id']
     else:
         # Create a new page
-        result = confluence.create_page(
+        result = _get_confluence().create_page(
             space=space,
             title=title,
             body=content,
             parent_id=parent_id
         )
         print(f"Page '{title}' created successfully with ID: {result['id']}")
+        return result['id']
+
+def format_default_title(number):
+    """
+    Format a generated title with a zero-padded number, e.g. "New Generated Document 001".
+    """
+    return f"{DEFAULT_TITLE_BASE} {number:03d}"
 
 def generate_default_title(space):
     """
     Generate a default title based on existing pages with "New Generated Document" in their title.
     """
-    base_title = "New Generated Document"
+    base_title = DEFAULT_TITLE_BASE
     
-    # Search for pages with the base title
+    # title ~ is a fuzzy match and sorting by title is a string sort, so page through every result
+    # and take the numeric maximum instead of trusting the first few
     cql = f'space = "{space}" AND title ~ "{base_title}"'
-    search_results = confluence.cql(cql, limit=100)
+    highest = 0
+    start = 0
+    while True:
+        results = _get_confluence().cql(cql, start=start, limit=TITLE_SEARCH_PAGE_SIZE).get('results', [])
+        for result in results:
+            match = _TITLE_RE.match(result.get('title', ''))
+            if match and match.group(1):
+                highest = max(highest, int(match.group(1)))
+        if len(results) < TITLE_SEARCH_PAGE_SIZE:
+            break
+        start += len(results)
     
-    # Extract existing numbers from titles
-    numbers = []
-    pattern = re.compile(rf"{base_title}(?: (\d+))?")
+    return format_default_title(highest + 1)
+
+def build_prompt(template_body, markdown_content):
+    """
+    Build a compact Gemini prompt for merging markdown content into a Confluence template.
+    """
+    # HTML is whitespace-insensitive, so collapse the template's whitespace to save input tokens
+    template_body = _WHITESPACE_RE.sub(' ', template_body).strip()
     
-    if 'results' in search_results:
-        for result in search_results['results']:
-            if 'title' in result:
-                match = pattern.match(result['title'])
-                if match:
-                    num_str = match.group(1)
-                    if num_str:
-                        numbers.append(int(num_str))
-                    else:
-                        numbers.append(0)  # For the base title without a number
+    return (
+        "Convert ALL of the markdown to Confluence storage-format HTML and merge it into the template.\n"
+        "Keep every section, heading, list and table; never truncate.\n"
+        "Use <code> for inline code and no ``` fences for code blocks.\n"
+        "Return ONLY the final HTML.\n"
+        f"TEMPLATE:\n{template_body}\n"
+        f"MARKDOWN:\n{markdown_content}"
+    )
+
+def build_continuation_prompt(markdown_content):
+    """
+    Build a Gemini prompt for a later chunk of a split markdown file.
+    Only the first chunk is merged into the template; the rest is converted and appended after it.
+    """
+    return (
+        "Convert ALL of this markdown, a continuation of a larger document, to Confluence storage-format HTML.\n"
+        "Keep every section, heading, list and table; never truncate.\n"
+        "Use <code> for inline code and no ``` fences for code blocks.\n"
+        "Return ONLY the HTML fragment.\n"
+        f"MARKDOWN:\n{markdown_content}"
+    )
+
+def _approx_tokens(text):
+    """
+    Approximate the token count of text locally, at roughly 4 characters per token.
+    """
+    return max(len(text) // 4, len(text.split()))
+
+def prompt_fits(client, prompt):
+    """
+    Check whether a prompt fits in PROMPT_TOKEN_LIMIT.
+    Uses the local estimate, and only asks the Gemini tokenizer when the estimate is within 10% of the limit.
+    """
+    tokens = _approx_tokens(prompt)
+    if abs(tokens - PROMPT_TOKEN_LIMIT) <= PROMPT_TOKEN_LIMIT * 0.1:
+        try:
+            tokens = client.models.count_tokens(model=GEMINI_MODEL, contents=prompt).total_tokens
+        except Exception as e:
+            # The exact count is only a tiebreaker, so keep the local estimate if the tokenizer call fails
+            print(f"Warning: Could not count prompt tokens, using the local estimate: {e}")
+    return tokens <= PROMPT_TOKEN_LIMIT
+
+def _split_recursive(text, max_tokens, separators):
+    """
+    Split text on the first separator, recursing into the next one for pieces that are still too large.
+    Separators stay attached to the end of each piece so joining the pieces restores the text.
+    """
+    if _approx_tokens(text) <= max_tokens or not separators:
+        return [text]
+    
+    pieces = []
+    for piece in re.split(f"(?<={re.escape(separators[0])})", text):
+        if piece:
+            pieces.extend(_split_recursive(piece, max_tokens, separators[1:]))
+    return pieces
+
+def split_markdown(markdown_content, max_tokens):
+    """
+    Split markdown into chunks of at most max_tokens (approximately), preferring level-2 heading boundaries,
+    then paragraphs, then lines. A fenced code block is never split, even if it is larger than max_tokens.
+    """
+    def split_prose(text):
+        for section in _H2_SPLIT_RE.split(text):
+            if section:
+                pieces.extend(_split_recursive(section, max_tokens, ("\n\n", "\n")))
     
-    # Determine the next number
-    next_num = 1
-    if numbers:
-        next_num = max(numbers) + 1
+    # Fenced code blocks are kept whole, so chunk boundaries (and "## " lines inside code) never split them
+    pieces = []
+    position = 0
+    for fence in _FENCE_RE.finditer(markdown_content):
+        split_prose(markdown_content[position:fence.start()])
+        pieces.append(fence.group(0))
+        position = fence.end()
+    split_prose(markdown_content[position:])
     
-    # Format with leading zeros
-    return f"{base_title} {next_num:03d}" if next_num > 0 else base_title
+    # Pack adjacent pieces back together up to the chunk size
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and _approx_tokens(current + piece) > max_tokens:
+            chunks.append(current)
+            current = piece
+        else:
+            current += piece
+    if current:
+        chunks.append(current)
+    
+    return chunks
 
-def fill_template_with_markdown(template_body, markdown_file):
+def generate_html(client, prompt):
+    """
+    Stream a single Gemini generation for a prompt.
+    
+    Args:
+        client (genai.Client): The Gemini client
+        prompt (str): The prompt to send
+    
+    Returns:
+        tuple: (generated HTML, usage dict), or (None, None) if the output was abandoned as unusable
+    """
+    from google.genai import types
+    
+    # One-shot streamed request; no chat history is needed for a single prompt
+    stream = client.models.generate_content_stream(
+        model=GEMINI_MODEL,
+        contents=prompt,
+        config=types.GenerateContentConfig(
+            max_output_tokens=GEMINI_MAX_OUTPUT_TOKENS,
+            temperature=0.2
+        )
+    )
+    
+    # Accumulate the streamed chunks, giving up early if the output is clearly unusable
+    parts = []
+    generated_length = 0
+    fence_count = 0
+    usage = None
+    for chunk in stream:
+        text = chunk.text or ""
+        parts.append(text)
+        generated_length += len(text)
+        fence_count += text.count("```")
+        if chunk.usage_metadata:
+            usage = chunk.usage_metadata
+        
+        if fence_count > MAX_CODE_FENCES or generated_length > MAX_GENERATION_CHARS:
+            print("Warning: Generated content looks like markdown or is far longer than expected.")
+            return None, None
+    
+    usage = {
+        'prompt_token_count': usage.prompt_token_count or 0,
+        'candidates_token_count': usage.candidates_token_count or 0,
+        'total_token_count': usage.total_token_count or 0
+    } if usage else None
+    
+    return "".join(parts), usage
+
+def generation_cache_key(template_body, markdown_content):
+    """
+    Hash everything that determines the Gemini output into a cache key.
+    """
+    return hashlib.sha256(b"|".join([
+        template_body.encode(),
+        markdown_content.encode(),
+        GEMINI_MODEL.encode(),
+        PROMPT_VERSION.encode()
+    ])).hexdigest()
+
+def read_cached_generation(key):
+    """
+    Return a previously generated HTML for the cache key, or None if there is none.
+    An HTML file without its JSON sidecar is treated as incomplete and ignored.
+    """
+    cache_file = os.path.join(GEMINI_CACHE_DIR, f"{key}.html")
+    if not os.path.exists(os.path.join(GEMINI_CACHE_DIR, f"{key}.json")):
+        return None
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            return f.read() or None
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        print(f"Warning: Could not read Gemini cache: {e}")
+        return None
+
+def _write_atomic(path, text):
+    """
+    Write text to path via a temporary file in the same directory, so readers never see a partial file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def write_cached_generation(key, generation, usage=None):
+    """
+    Store generated HTML under the cache key, with a JSON sidecar describing the generation.
+    """
+    metadata = {
+        'model': GEMINI_MODEL,
+        'prompt_version': PROMPT_VERSION,
+        'created': time.time(),
+        'usage_metadata': usage
+    }
+    try:
+        os.makedirs(GEMINI_CACHE_DIR, exist_ok=True)
+        # The sidecar marks the entry complete, so it is written only after the HTML is in place
+        _write_atomic(os.path.join(GEMINI_CACHE_DIR, f"{key}.html"), generation)
+        _write_atomic(os.path.join(GEMINI_CACHE_DIR, f"{key}.json"), json.dumps(metadata))
+    except OSError as e:
+        print(f"Warning: Could not write Gemini cache: {e}")
+
+def fill_template_with_markdown(template_body, markdown_file, use_cache=True):
     """
     Fill in the blanks of a template using a markdown file.
     The AI will identify template structure and intelligently fill it with markdown content.
+    Results are cached on disk, so unchanged template and markdown skip the Gemini call.
     """
     # Check if template_body is a dict, and extract the actual content
     if isinstance(template_body, dict):
         # Try to find the actual body content in the dictionary
-        for key in ['body', 'templateBody', 'contentTemplateBody', 'value']:
-            if key in template_body:
-                template_body = template_body[key]
-                break
+        body_key = next((key for key in TEMPLATE_BODY_KEYS + ('value',) if key in template_body), None)
+        if body_key:
+            template_body = template_body[body_key]
         else:
             # If no recognized body key is found, convert dict to string safely
             try:
@@ -147,79 +557,90 @@ def fill_template_with_markdown(template_body, markdown_file):
     if not isinstance(template_body, str):
         template_body = str(template_body)
     
-    with open(markdown_file, 'r') as md_file:
-        markdown_content = md_file.read()
+    # The direct HTML conversion is only rendered if a fallback is needed
+    markdown_content = read_markdown(markdown_file)
+    
+    # Reuse an earlier generation for the same template and markdown
+    cache_key = generation_cache_key(template_body, markdown_content)
+    if use_cache:
+        cached = read_cached_generation(cache_key)
+        if cached is not None:
+            print(f"Using cached Gemini output ({cache_key[:12]})")
+            return cached
+    
+    from google import genai
+    
+    # Configure Gemini API
+    GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+    if not GEMINI_API_KEY:
+        raise ValueError("GEMINI_API_KEY environment variable is not set")
+
+    # Create a client with the API key
+    client = genai.Client(api_key=GEMINI_API_KEY)
+    
+    # Use Gemini to merge template with markdown content
+    try:
+        # Send the whole document with the template whenever it fits, so every section can be merged in place.
+        # Only documents too large for one call are split; the first chunk then carries the template.
+        template_tokens = _approx_tokens(template_body)
+        output_estimate = template_tokens + _approx_tokens(markdown_content) * HTML_GROWTH_RATIO
+        if output_estimate <= GEMINI_MAX_OUTPUT_TOKENS and \
+           prompt_fits(client, build_prompt(template_body, markdown_content)):
+            chunks = [markdown_content]
+        else:
+            chunk_tokens = max(MIN_CHUNK_TOKENS, (GEMINI_MAX_OUTPUT_TOKENS - template_tokens) // HTML_GROWTH_RATIO)
+            chunks = split_markdown(markdown_content, chunk_tokens) or [markdown_content]
+        prompts = [build_prompt(template_body, chunks[0])] + [build_continuation_prompt(chunk) for chunk in chunks[1:]]
+        if len(chunks) > 1:
+            print(f"Splitting markdown into {len(chunks)} chunks for Gemini")
         
-        # Use the markdown library to convert markdown to HTML
-        html_content = markdown.markdown(markdown_content, 
-                                       extensions=['fenced_code', 'codehilite', 'tables'])
+        # The template alone can still push the first prompt past the limit
+        if len(chunks) > 1 and not prompt_fits(client, prompts[0]):
+            print("Warning: Template is too large for a single Gemini prompt. Using direct HTML conversion.")
+            return render_markdown(markdown_file)
         
-        # Configure Gemini API
-        GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-        if not GEMINI_API_KEY:
-            raise ValueError("GEMINI_API_KEY environment variable is not set")
-
-        # Create a client with the API key
-        client = genai.Client(api_key=GEMINI_API_KEY)
+        with ThreadPoolExecutor(max_workers=min(MAX_GEMINI_WORKERS, len(prompts))) as executor:
+            results = list(executor.map(lambda prompt: generate_html(client, prompt), prompts))
         
-        # Use Gemini to merge template with markdown content
-        try:
-            prompt = f"""
-            I need to convert markdown content into Confluence-compatible HTML and merge it with a template.
-            
-            CONFLUENCE TEMPLATE:
-            {template_body}
-            
-            MARKDOWN CONTENT:
-            {markdown_content}
-            
-            Please:
-            1. Convert ALL of the markdown content to proper Confluence HTML format
-            2. Merge it with the template structure
-            3. Ensure ALL sections of the markdown are included (especially beyond "## How to Use")
-            4. Format inline code tags (`like this`) as <code> elements
-            5. Format code blocks correctly for Confluence (without ```html or ``` markers)
-            6. Preserve all headings, lists, tables and other formatting
-            7. DO NOT truncate the content - include EVERYTHING from the markdown file
-            
-            Return ONLY the final HTML content without any markdown or code block markers.
-            """
-            
-            # Use the highest token limit model available to ensure full content processing
-            chat = client.chats.create(model="gemini-1.5-pro-latest", 
-                                       generation_config={"max_output_tokens": 8192})
-            
-            # Send message synchronously
-            response = chat.send_message(prompt)
-            generation = response.text
-            
-            # Post-process the response to remove any remaining markdown code block markers
-            generation = generation.replace("```html", "").replace("```", "")
-            
-            # Check if the generation seems complete
-            if "## How to Use" in markdown_content and "## How to Use" in generation and \
-               len(generation) < len(markdown_content):
-                print("Warning: Generated content may be truncated. Using direct HTML conversion.")
-                return html_content
-                
-            return generation
-        except Exception as e:
-            print(f"Error using Gemini API: {e}")
-            # Fallback: Just use direct HTML conversion
-            return html_content
+        if any(generated is None for generated, _ in results):
+            print("Using direct HTML conversion.")
+            return render_markdown(markdown_file)
+        
+        # Total the token usage over all chunks
+        usage = None
+        for _, chunk_usage in results:
+            if chunk_usage:
+                usage = usage or dict.fromkeys(chunk_usage, 0)
+                for name, count in chunk_usage.items():
+                    usage[name] += count
+        if usage:
+            print(f"Gemini token usage: prompt={usage['prompt_token_count']}, "
+                  f"output={usage['candidates_token_count']}")
+        
+        generation = "\n".join(generated for generated, _ in results)
+        
+        # Post-process the response to remove any remaining markdown code block markers
+        generation = generation.replace("```html", "").replace("```", "")
+        
+        # Check if the generation seems complete
+        if "## How to Use" in markdown_content and "## How to Use" in generation and \
+           len(generation) < len(markdown_content):
+            print("Warning: Generated content may be truncated. Using direct HTML conversion.")
+            return render_markdown(markdown_file)
+        
+        write_cached_generation(cache_key, generation, usage)
+        return generation
+    except Exception as e:
+        print(f"Error using Gemini API: {e}")
+        # Fallback: Just use direct HTML conversion
+        return render_markdown(markdown_file)
 
 def process_direct_markdown(markdown_file):
     """
     Process markdown file directly to HTML without template.
     """
-    with open(markdown_file, 'r') as md_file:
-        markdown_content = md_file.read()
-    
-    # Convert markdown directly to HTML with extensions for proper formatting
-    html_content = markdown.markdown(markdown_content, 
-                                   extensions=['fenced_code', 'codehilite', 'tables'])
-    
-    return html_content
+    # Convert markdown directly to HTML, reusing an earlier conversion of the same file
+    return render_markdown(markdown_file)
 
 def attach_file_to_page(page_id, file_path):
     """
@@ -242,7 +663,7 @@ def attach_file_to_page(page_id, file_path):
             return None
         
         # Attach file to the page
-        result = confluence.attach_file(file_path, page_id=page_id)
+        result = _get_confluence().attach_file(file_path, page_id=page_id)
         print(f"Successfully attached {filename}")
         return filename
     except Exception as e:
@@ -263,18 +684,14 @@ def add_attachment_links(content, attachments):
     if not attachments:
         return content
         
-    # Create an attachments section
-    attachments_html = "\n<h2>Attachments</h2>\n<ul>"
-    
-    # Add each attachment as a list item with a link
-    for attachment in attachments:
-        # Confluence uses a special macro format for attachment links
-        attachments_html += f'\n<li><ac:link><ri:attachment ri:filename="{attachment}" /></ac:link></li>'
+    # Add each attachment as a list item with a link; Confluence uses a special macro format for attachment links
+    items = "\n".join(
+        f'<li><ac:link><ri:attachment ri:filename="{html.escape(attachment, quote=True)}" /></ac:link></li>'
+        for attachment in attachments
+    )
     
-    attachments_html += "\n</ul>"
-    
-    # Append to the content
-    return content + attachments_html
+    # Append an attachments section to the content
+    return f"{content}\n<h2>Attachments</h2>\n<ul>\n{items}\n</ul>"
 
 def main():
     # Set up command line arguments
@@ -285,6 +702,8 @@ def main():
     parser.add_argument('--title', dest='title', help='Title for the Confluence page')
     parser.add_argument('--markdown-file', dest='markdown_file', required=True, help='Path to the markdown file (required)')
     parser.add_argument('--parent-page', dest='parent_page', help='Name of the parent page in the specified space')
+    parser.add_argument('--refresh-templates', dest='refresh_templates', action='store_true', help='Ignore the local template cache and fetch templates from Confluence')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', help='Ignore cached Gemini output and call the API again')
     parser.add_argument('--attach', dest='attachments', action='append', help='Path to file(s) to attach to the page (can be used multiple times)')
     
     args = parser.parse_args()
@@ -293,86 +712,80 @@ def main():
     space = args.space
     markdown_file = args.markdown_file
     
-    # Generate default title if not provided
-    if not args.title:
-        title = generate_default_title(space)
-        print(f"Using generated title: {title}")
-    else:
-        title = args.title
-    
-    # Get parent page ID if specified
-    parent_id = get_parent_page_id(space, args.parent_page)
+    # Create the client before any worker threads use it
+    confluence = _get_confluence()
     
     # Determine if we should use a template
     use_template = not args.no_template and args.template_name
     
-    if use_template:
-        template = get_template(args.template_name)
+    # The startup lookups don't depend on each other, so run them concurrently over the shared session
+    with ThreadPoolExecutor(max_workers=MAX_STARTUP_WORKERS) as executor:
+        # Generate default title if not provided; otherwise the page lookup can start right away
+        if not args.title:
+            title_future = executor.submit(generate_default_title, space)
+        else:
+            page_future = executor.submit(confluence.get_page_by_title, space, args.title)
+        
+        # Get parent page ID if specified
+        parent_future = executor.submit(get_parent_page_id, space, args.parent_page)
+        
+        if use_template:
+            template_future = executor.submit(get_template, args.template_name, refresh=args.refresh_templates)
         
+        if not args.title:
+            title = title_future.result()
+            # A generated title must name a new page, so never update a page that already has it
+            existing_page = confluence.get_page_by_title(space, title)
+            while existing_page:
+                print(f"Page '{title}' already exists. Trying the next number.")
+                title = format_default_title(int(_TITLE_RE.match(title).group(1)) + 1)
+                existing_page = confluence.get_page_by_title(space, title)
+            print(f"Using generated title: {title}")
+        else:
+            title = args.title
+            existing_page = page_future.result()
+        
+        parent_id = parent_future.result()
+        template = template_future.result() if use_template else None
+    
+    if use_template:
         # Check if the template was found
         if not template:
             print(f"Template '{args.template_name}' not found. Using direct markdown conversion.")
             content = process_direct_markdown(markdown_file)
         else:
             print(f"Filling template '{args.template_name}' with content from {markdown_file}")
-            content = fill_template_with_markdown(template, markdown_file)
+            content = fill_template_with_markdown(template, markdown_file, use_cache=not args.no_cache)
     else:
         print(f"Using direct markdown conversion for {markdown_file}")
         content = process_direct_markdown(markdown_file)
     
     # Check if content seems truncated
-    with open(markdown_file, 'r') as md_file:
-        markdown_content = md_file.read()
+    markdown_content = read_markdown(markdown_file)
             
     # If the last heading in markdown doesn't appear in content, append direct HTML
-    sections = re.findall(r'##\s+([^\n]+)', markdown_content)
+    sections = _H2_RE.findall(markdown_content)
     if sections and sections[-1] not in content:
         print("Warning: Content appears truncated. Appending direct HTML conversion.")
         html_content = process_direct_markdown(markdown_file)
         content = f"{content}\n<hr/>\n<h2>Additional Content:</h2>\n{html_content}"
     
-    # Create or update the page first (without attachments)
-    existing_page = confluence.get_page_by_title(space, title)
-    if existing_page:
-        # Update the existing page
-        confluence.update_page(
-            page_id=existing_page['id'],
-            title=title,
-            body=content
-        )
-        page_id = existing_page['id']
-        print(f"Page '{title}' updated successfully.")
-    else:
-        # Create a new page
-        result = confluence.create_page(
-            space=space,
-            title=title,
-            body=content,
-            parent_id=parent_id
-        )
-        page_id = result['id']
-        print(f"Page '{title}' created successfully with ID: {page_id}")
+    # Add attachment links up front so the page is written only once;
+    # Confluence resolves the links by filename once the files are attached
+    attachments = [path for path in args.attachments or [] if os.path.exists(path)]
+    content = add_attachment_links(content, [os.path.basename(path) for path in attachments])
+    
+    # Create or update the page
+    page_id = create_or_edit_page(space, title, content, parent_id, existing_page)
     
-    # Attach files if specified and add links to them
+    # Attach files if specified
     if args.attachments:
-        successful_attachments = []
+        # Upload attachments in parallel over the shared session, keeping concurrency bounded
+        with ThreadPoolExecutor(max_workers=min(MAX_ATTACHMENT_WORKERS, len(args.attachments))) as executor:
+            results = list(executor.map(lambda path: attach_file_to_page(page_id, path), args.attachments))
         
-        for attachment in args.attachments:
-            filename = attach_file_to_page(page_id, attachment)
-            if filename:
-                successful_attachments.append(filename)
-        
-        # If there were successful attachments, add links and update the page
-        if successful_attachments:
-            updated_content = add_attachment_links(content, successful_attachments)
-            
-            # Update the page with attachment links
-            confluence.update_page(
-                page_id=page_id,
-                title=title,
-                body=updated_content
-            )
-            print(f"Added attachment links to page '{title}'")
+        successful_attachments = [filename for filename in results if filename]
+        print(f"Attached {len(successful_attachments)} of {len(args.attachments)} file(s) to page '{title}'")
 
 if __name__ == "__main__":
     main()